@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous (asyncio) versions of the HipChat notification functions.
+
+This module lets a message be sent to many rooms concurrently, so that
+the time taken is that of the slowest request rather than the sum of
+them all:
+
+    >>> await hipchat.async_notifications.broadcast(['Sales', 'Support'], 'Hello')
+
+Requires Python 3.5+ and aiohttp, which is an optional dependency:
+
+    $ pip install hipchat-notifications[async]
+
+Tokens are taken from the same HIPCHAT_API_TOKEN pool as the
+hipchat.notifications functions.
+
+"""
+import asyncio
+
+import aiohttp
+
+from . import notifications
+from .exceptions import HipChatError
+from .notifications import (
+    _body,
+    logger,
+    REQUEST_TIMEOUT,
+    SEND_ROOM_MESSAGE_URL,
+    VALID_COLORS,
+    VALID_FORMATS,
+)
+
+# maximum number of simultaneous connections opened by broadcast
+CONNECTION_LIMIT = 20
+_TIMEOUT = aiohttp.ClientTimeout(
+    sock_connect=REQUEST_TIMEOUT[0],
+    sock_read=REQUEST_TIMEOUT[1]
+)
+
+
+class _ErrorResponse(object):
+
+    """Minimal stand-in for requests.Response, used to build HipChatError."""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+
+async def notify_room_async(
+    session,
+    room,
+    message,
+    color='yellow',
+    label=None,
+    notify=False,
+    message_format='html'
+):
+    """
+    Send a room notification via 'Send room notification' API.
+
+    Unlike notify_room, rate-limited requests are not retried.
+
+    Args:
+        session: the aiohttp.ClientSession used to send the request
+        room: The id or url encoded name of the room
+        message: The message body (1-10,000 chars)
+
+    Kwargs:
+        see notify_room
+
+    Returns the aiohttp.ClientResponse if successful, else raises HipChatError.
+    Raises ValueError if the message is empty, or if there is an API token
+    and the color or format is invalid.
+
+    """
+    if not message:
+        raise ValueError("Message too short, must be 1-10,000 chars.")
+    if not notifications._TOKENS:
+        logger.debug("HipChat API token not found, logging message instead:")
+        logger.debug(message)
+        return
+    if color not in VALID_COLORS:
+        raise ValueError("Invalid color value: {}".format(color))
+    if message_format not in VALID_FORMATS:
+        raise ValueError("Invalid format: {}".format(message_format))
+
+    headers = {'Content-Type': 'application/json'}
+    headers.update(notifications._AUTH_HEADERS[notifications._token()])
+    body = _body(message, color, label, notify, message_format)
+
+    async with session.post(
+        SEND_ROOM_MESSAGE_URL(room),
+        data=body,
+        headers=headers,
+        timeout=_TIMEOUT
+    ) as resp:
+        if resp.status >= 400:
+            content = await resp.read()
+            raise HipChatError(_ErrorResponse(resp.status, content))
+        return resp
+
+
+async def broadcast(rooms, message, **kwargs):
+    """
+    Send the same notification to a number of rooms concurrently.
+
+    Args:
+        rooms: an iterable of room ids or url encoded names
+        message: The message body (1-10,000 chars)
+
+    Kwargs:
+        see notify_room
+
+    Returns a list with a result for each room, in the same order - either
+    the response (as returned by notify_room_async) or the exception raised.
+
+    """
+    connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        return await asyncio.gather(
+            *(notify_room_async(session, room, message, **kwargs) for room in rooms),
+            return_exceptions=True
+        )
@@ -3,3 +3,34 @@ try:
     from unittest import mock
 except ImportError:
     import mock  # noqa
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # noqa
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    # not available before Python 3.2
+    QueueHandler = QueueListener = None
+
+try:
+    # optional, faster JSON encoding / decoding
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    import json
+
+    def json_dumps(obj):
+        """Return obj encoded as JSON bytes."""
+        return json.dumps(obj).encode('utf-8')
+
+    json_loads = json.loads
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
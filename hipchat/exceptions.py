@@ -1,4 +1,6 @@
 """Custom hipchat exception classes."""
+from .compat import json_loads
+
 # see https://developer.atlassian.com/hipchat/guide/hipchat-rest-api/api-response-codes
 BAD_RESPONSE_CODES = (400, 401, 403, 404, 405, 429, 500, 503)
 
@@ -11,12 +13,13 @@ class HipChatError(Exception):
         assert response.status_code in BAD_RESPONSE_CODES, (
             "Invalid HipChatError response.status_code:{}".format(response)
         )
-        assert 'error' in response.json(), (
-            "Invalid HipChatError response.json(): {}".format(response)
+        payload = json_loads(response.content)
+        assert 'error' in payload, (
+            "Invalid HipChatError response.content: {}".format(payload)
         )
         self.status_code = response.status_code
         # NB this is brittle and depends on the API error response existing
         # in the correct format. This is by design - if the response format
         # changes we need to know.
-        self.message = response.json()['error']['message']
+        self.message = payload['error']['message']
         super(HipChatError, self).__init__()
@@ -1,7 +1,32 @@
 """HipChat enabled python logger."""
+import copy
 import logging
+import time
 
-from .notifications import notify_room
+from .compat import queue, QueueHandler, QueueListener, string_types
+from .notifications import MAX_MESSAGE_LENGTH, notify_room
+
+# maximum number of records buffered by HipChatHandler.install
+QUEUE_SIZE = 1000
+# maximum number of records coalesced into a single notification
+BATCH_SIZE = 50
+# seconds from the first record in a batch until the batch is sent
+BATCH_WINDOW = 0.2
+# separator used to join batched messages, by message_format
+SEPARATORS = {'html': '<br/>', 'text': '\n'}
+
+
+def _message(record):
+    """
+    Return the message for a record.
+
+    This is record.getMessage(), but skips the string formatting when
+    the record has no args and the msg is already a string.
+
+    """
+    if not record.args and isinstance(record.msg, string_types):
+        return record.msg
+    return record.getMessage()
 
 
 class HipChatHandler(logging.Handler):
@@ -45,14 +70,251 @@ class HipChatHandler(logging.Handler):
         self.notify = notify
         self.colors = colors
         self.message_format = message_format
+        self._colors_snapshot = None
+        self._colors_by_levelno = {}
+
+    def install(
+        self,
+        logger,
+        maxsize=QUEUE_SIZE,
+        batch_size=BATCH_SIZE,
+        batch_window=BATCH_WINDOW
+    ):
+        """
+        Attach this handler to a logger without blocking the caller.
+
+        Records logged to the logger are put on a queue, and a background
+        QueueListener thread passes them on to this handler, so that
+        logging calls do not wait on the HipChat API round-trip. If the
+        queue is full records are dropped (and counted) rather than
+        blocking the caller.
+
+        Records arriving in quick succession are coalesced into a single
+        notification (see emit_batch) to save on API calls.
+
+        Args:
+            logger: the logging.Logger to attach to
+
+        Kwargs:
+            maxsize: the maximum number of records to buffer
+            batch_size: the maximum number of records sent in one notification
+            batch_window: seconds from the first record in a batch until it is sent
+
+        Requires Python 3.2+ (logging.handlers.QueueListener), otherwise
+        raises RuntimeError.
+
+        Returns the started QueueListener - call listener.stop() to flush
+        the queue on shutdown, e.g. atexit.register(listener.stop). The
+        number of records dropped because the queue was full is available
+        as listener.dropped.
+
+        """
+        if QueueListener is None:
+            raise RuntimeError("HipChatHandler.install requires Python 3.2+")
+        q = queue.Queue(maxsize)
+        handler = _DroppingQueueHandler(q)
+        handler.setLevel(self.level)
+        listener = _BatchingQueueListener(q, self, batch_size, batch_window)
+        listener.queue_handler = handler
+        listener.start()
+        logger.addHandler(handler)
+        return listener
+
+    def _color(self, record):
+        """
+        Return the color for a record.
+
+        Colors are looked up by the integer record.levelno, which is
+        cheaper than the levelname string, in a table built from
+        self.colors. The table is rebuilt whenever self.colors has changed
+        (either replaced or modified in place). Exact level names take
+        priority over aliases (e.g. 'WARNING' over 'WARN'), and levels
+        not in the table (e.g. added with logging.addLevelName since it
+        was built) fall back to a lookup by record.levelname.
+
+        """
+        if self._colors_snapshot != self.colors:
+            aliases = {}
+            names = {}
+            for name, color in self.colors.items():
+                levelno = logging.getLevelName(name)
+                if not isinstance(levelno, int):
+                    continue
+                if logging.getLevelName(levelno) == name:
+                    names[levelno] = color
+                else:
+                    aliases[levelno] = color
+            aliases.update(names)
+            self._colors_by_levelno = aliases
+            self._colors_snapshot = dict(self.colors)
+        try:
+            return self._colors_by_levelno[record.levelno]
+        except KeyError:
+            return self.colors.get(record.levelname, 'yellow')
+
+    @property
+    def separator(self):
+        """Return the string used to join batched messages."""
+        return SEPARATORS.get(self.message_format, '\n')
 
     def emit(self, record):
         """Send the record info to HipChat."""
-        notify_room(
-            self.room,
-            record.getMessage(),
-            color=self.colors.get(record.levelname, 'yellow'),
-            label=self.label,
-            notify=self.notify,
-            message_format=self.message_format
-        )
+        self.emit_batch([record])
+
+    def emit_batch(self, records):
+        """
+        Send a list of records to HipChat as a single notification.
+
+        The messages are joined using the separator, and the notification
+        uses the color of the most severe record.
+
+        Errors raised sending the notification are passed to handleError,
+        so that a failed send does not stop the QueueListener thread.
+
+        """
+        worst = max(records, key=lambda record: record.levelno)
+        try:
+            notify_room(
+                self.room,
+                self.separator.join(_message(record) for record in records),
+                color=self._color(worst),
+                label=self.label,
+                notify=self.notify,
+                message_format=self.message_format
+            )
+        except Exception:
+            self.handleError(worst)
+
+
+if QueueHandler is not None:
+
+    class _DroppingQueueHandler(QueueHandler):
+
+        """QueueHandler that drops records when the queue is full."""
+
+        def __init__(self, q):
+            QueueHandler.__init__(self, q)
+            self.dropped = 0
+
+        def prepare(self, record):
+            """
+            Return a copy of record, ready to be put on the queue.
+
+            Unlike QueueHandler.prepare the record is not formatted, so the
+            queued message is the same as HipChatHandler.emit would send -
+            tracebacks are not added to the message. The args and exc_info
+            are removed as they may not be picklable.
+
+            """
+            message = _message(record)
+            record = copy.copy(record)
+            record.message = record.msg = message
+            record.args = None
+            record.exc_info = None
+            record.exc_text = None
+            return record
+
+        def enqueue(self, record):
+            """Put record on the queue, or drop it if the queue is full."""
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+    class _BatchingQueueListener(QueueListener):
+
+        """QueueListener that passes records to the handler in batches."""
+
+        def __init__(self, q, handler, batch_size, batch_window):
+            QueueListener.__init__(self, q, handler)
+            self.batch_size = batch_size
+            self.batch_window = batch_window
+            # the _DroppingQueueHandler feeding the queue, set by install
+            self.queue_handler = None
+
+        @property
+        def dropped(self):
+            """Return the number of records dropped because the queue was full."""
+            return self.queue_handler.dropped if self.queue_handler else 0
+
+        def enqueue_sentinel(self):
+            """
+            Put the sentinel on the queue, waiting for room if it is full.
+
+            QueueListener uses put_nowait, which raises queue.Full (and so
+            stops stop() from flushing the queue) if the queue is full.
+
+            """
+            self.queue.put(self._sentinel)
+
+        def _wanted(self, handler, record):
+            """Return True if record passes the handler's level and filters."""
+            return record.levelno >= handler.level and handler.filter(record)
+
+        def _task_done(self, count=1):
+            """Call queue.task_done count times, if the queue supports it."""
+            if hasattr(self.queue, 'task_done'):
+                for _ in range(count):
+                    self.queue.task_done()
+
+        def _monitor(self):
+            """
+            Pull records off the queue and pass them to handler.emit_batch.
+
+            Records are checked against the handler's level and filters,
+            as in Handler.handle, and the handler lock is held while each
+            batch is sent.
+
+            A batch is sent batch_window seconds after its first record
+            arrived, when it holds batch_size records, or when the next record
+            would take it over MAX_MESSAGE_LENGTH, in which case that
+            record starts the next batch.
+
+            As in QueueListener, task_done is called for every record taken
+            off the queue (including the sentinel), once it has been handled.
+
+            """
+            handler = self.handlers[0]
+            separator = len(handler.separator)
+            record = self.dequeue(True)
+            # True if record has been carried over from the last batch, in
+            # which case it has already been checked by _wanted
+            carry = False
+            while record is not self._sentinel:
+                if not carry and not self._wanted(handler, record):
+                    self._task_done()
+                    record = self.dequeue(True)
+                    continue
+                batch = [record]
+                length = len(_message(record))
+                carry = False
+                deadline = time.monotonic() + self.batch_window
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        record = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if record is self._sentinel:
+                        carry = True
+                        break
+                    if not self._wanted(handler, record):
+                        self._task_done()
+                        continue
+                    length += separator + len(_message(record))
+                    if length > MAX_MESSAGE_LENGTH:
+                        carry = True
+                        break
+                    batch.append(record)
+                handler.acquire()
+                try:
+                    handler.emit_batch(batch)
+                finally:
+                    handler.release()
+                self._task_done(len(batch))
+                if not carry:
+                    record = self.dequeue(True)
+            # the sentinel
+            self._task_done()
@@ -19,23 +19,129 @@ import logging
 import os
 import random
 import requests
+import socket
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from .compat import json_dumps
 from .exceptions import HipChatError
 
-if os.environ.get('HIPCHAT_API_SERVER'):
-    API_SERVER_HOST = os.environ.get('HIPCHAT_API_SERVER')
-else:
-    API_SERVER_HOST = 'api.hipchat.com'
-
-API_V2_ROOT = API_V2_ROOT = 'https://' + API_SERVER_HOST + '/v2/'
-SEND_USER_MESSAGE_URL = lambda user: "{}user/{}/message".format(API_V2_ROOT, user)
-SEND_ROOM_MESSAGE_URL = lambda room: "{}room/{}/notification".format(API_V2_ROOT, room)
-VALID_COLORS = ('yellow', 'green', 'red', 'purple', 'gray', 'random')
-VALID_FORMATS = ('text', 'html')
+API_SERVER_HOST = os.environ.get('HIPCHAT_API_SERVER') or 'api.hipchat.com'
+API_V2_ROOT = 'https://' + API_SERVER_HOST + '/v2/'
+_USER_PREFIX = API_V2_ROOT + 'user/'
+_ROOM_PREFIX = API_V2_ROOT + 'room/'
+VALID_COLORS = frozenset(('yellow', 'green', 'red', 'purple', 'gray', 'random'))
+VALID_FORMATS = frozenset(('text', 'html'))
+MAX_MESSAGE_LENGTH = 10000
+MAX_LABEL_LENGTH = 64
+# (connect, read) timeouts, in seconds, for each API request
+REQUEST_TIMEOUT = (3.05, 10)
 
 logger = logging.getLogger('hipchat')
 
 
+def SEND_USER_MESSAGE_URL(user):
+    """Return the 'Send private message' API url for a user."""
+    return '%s%s/message' % (_USER_PREFIX, user)
+
+
+def SEND_ROOM_MESSAGE_URL(room):
+    """Return the 'Send room notification' API url for a room."""
+    return '%s%s/notification' % (_ROOM_PREFIX, room)
+
+
+class _JitterRetry(Retry):
+
+    """Retry policy that adds random jitter to the exponential backoff."""
+
+    def get_backoff_time(self):
+        """Return the backoff time plus up to backoff_factor seconds of jitter."""
+        backoff = super(_JitterRetry, self).get_backoff_time()
+        return backoff + random.uniform(0, self.backoff_factor)
+
+
+class _HipChatAdapter(HTTPAdapter):
+
+    """HTTPAdapter that sets TCP_NODELAY and SO_KEEPALIVE on its sockets."""
+
+    # TCP_NODELAY sends the (small) request immediately rather than waiting
+    # on Nagle's algorithm, SO_KEEPALIVE stops idle pooled connections from
+    # being silently dropped.
+    socket_options = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        super(_HipChatAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+# Rate limited (429) and transient server errors are retried transparently,
+# honouring any Retry-After header. raise_on_status=False means that once
+# retries are exhausted the final response is returned, and raised as a
+# HipChatError in the usual way. Read errors are not retried (read=False)
+# as the POST may already have been accepted, and resending it would send
+# a duplicate notification.
+_RETRY = _JitterRetry(
+    total=5,
+    read=False,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 503),
+    allowed_methods=frozenset(['POST']),
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+# A single shared session so that the underlying HTTPS connection to the
+# API server is pooled and kept alive between notifications, rather than
+# paying for a new TCP + TLS handshake on every call.
+_SESSION = requests.Session()
+_SESSION.mount('https://', _HipChatAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=_RETRY
+))
+_SESSION.headers.update({
+    'Host': API_SERVER_HOST,
+    'Content-Type': 'application/json'
+})
+
+
+def _headers(auth_token):
+    """
+    Return authentication headers for API requests.
+
+    Args:
+        auth_token: string, a valid v2 API token.
+
+    Returns a dict that can be passed into _SESSION.post as the
+    'headers' dict - the static 'Host' and 'Content-Type' headers
+    are set once on the session itself.
+
+    """
+    return {
+        'Authorization': 'Bearer {}'.format(auth_token),
+    }
+
+
+def _refresh_tokens():
+    """
+    Parse the HIPCHAT_API_TOKEN env var into the _TOKENS pool.
+
+    Also builds _AUTH_HEADERS, the _headers dict for each token, so that
+    they are not rebuilt on every API call.
+
+    This is run once at import time, and can be called again to pick
+    up changes to the environment.
+
+    """
+    global _TOKENS, _AUTH_HEADERS
+    tokens = (os.getenv('HIPCHAT_API_TOKEN') or '').split(',')
+    _TOKENS = tuple(token.strip() for token in tokens if token.strip())
+    _AUTH_HEADERS = dict((token, _headers(token)) for token in _TOKENS)
+
+
 def _token():
     """
     Get a valid 'personal' auth token from HIPCHAT_API_TOKEN env var.
@@ -47,32 +153,95 @@ def _token():
     in from the environ _could_ be a list of comma-separated tokens, in which
     case this function will pick one at random from the list.
 
+    The env var is parsed once, into _TOKENS, by _refresh_tokens.
+
     Return a token if one exists or None.
 
     """
+    return _TOKENS[random.randrange(len(_TOKENS))] if _TOKENS else None
+
+
+_refresh_tokens()
+
+
+_BODY_PREFIX = b'{"message":'
+# cache of _body_suffix return values, cleared when it gets too big
+_BODY_SUFFIXES = {}
+_BODY_SUFFIXES_MAX = 64
+
+
+def _body_suffix(color, label, notify, message_format):
+    """
+    Return the JSON-encoded request body that follows the message.
+
+    Everything except the message is usually the same from one call to
+    the next (e.g. the logger sends the same color and label each time),
+    so the encoded bytes are cached, keyed on the arguments.
+
+    """
+    key = (color, label, notify, message_format)
     try:
-        token = os.getenv('HIPCHAT_API_TOKEN')
-        return random.choice(token.split(',')).strip()
-    except AttributeError:
-        return None
+        return _BODY_SUFFIXES[key]
+    except KeyError:
+        pass
+    if not label:
+        label = ''
+    elif len(label) > MAX_LABEL_LENGTH:
+        label = label[:MAX_LABEL_LENGTH]
+    data = json_dumps({
+        'color': color,
+        'notify': notify,
+        'message_format': message_format,
+        'from': label
+    })
+    if len(_BODY_SUFFIXES) >= _BODY_SUFFIXES_MAX:
+        _BODY_SUFFIXES.clear()
+    # replace the opening brace to follow on from the message
+    suffix = _BODY_SUFFIXES[key] = b',' + data[1:]
+    return suffix
 
 
-def _headers(auth_token):
+def _body(message, color, label, notify, message_format):
     """
-    Return authentication headers for API requests.
+    Return the JSON-encoded request body as bytes.
+
+    Only the message is encoded on each call, the rest of the body
+    comes from _body_suffix. The message is only sliced (and so copied)
+    if it is over MAX_MESSAGE_LENGTH.
+
+    """
+    if len(message) > MAX_MESSAGE_LENGTH:
+        message = message[:MAX_MESSAGE_LENGTH]
+    return (
+        _BODY_PREFIX +
+        json_dumps(message) +
+        _body_suffix(color, label, notify, message_format)
+    )
 
-    Args:
-        auth_token: string, a valid v2 API token.
 
-    Returns a dict that can be passed into requests.post as the
-    'headers' dict.
+# cache of PreparedRequest objects, keyed on url, cleared when it gets too big
+_PREPARED_REQUESTS = {}
+_PREPARED_REQUESTS_MAX = 64
 
+
+def _prepared_request(url):
     """
-    return {
-        'Authorization': 'Bearer {}'.format(auth_token),
-        'Host': API_SERVER_HOST,
-        'Content-Type': 'application/json'
-    }
+    Return a copy of the PreparedRequest for a POST to url.
+
+    Preparing a request merges in the session headers, cookies, auth
+    etc. each time, so the prepared request is cached per url and a copy
+    returned, to which the auth headers and body can be added.
+
+    """
+    try:
+        prepared = _PREPARED_REQUESTS[url]
+    except KeyError:
+        if len(_PREPARED_REQUESTS) >= _PREPARED_REQUESTS_MAX:
+            _PREPARED_REQUESTS.clear()
+        prepared = _PREPARED_REQUESTS[url] = _SESSION.prepare_request(
+            requests.Request('POST', url)
+        )
+    return prepared.copy()
 
 
 def _api(
@@ -101,30 +270,37 @@ def _api(
             HipChat applications (VALID_FORMAT, default='html')
 
     Returns HTTP Response object if successful, else raises HipChatError.
+    Raises ValueError if the message is empty, or if there is an API token
+    and the color or format is invalid.
 
     """
-    # asserts - message, colour and format are acceptable
-    assert message is not None, "Missing message param"
-    assert len(message) >= 1, "Message too short, must be 1-10,000 chars."
-    assert color in VALID_COLORS, "Invalid color value: {}".format(color)
-    assert message_format in VALID_FORMATS, "Invalid format: {}".format(message_format)
-
-    token = _token()
-    if token is None:
+    if not message:
+        raise ValueError("Message too short, must be 1-10,000 chars.")
+    # without a token there is nothing else to do, so bail out before
+    # checking anything else or building the request
+    if not _TOKENS:
         logger.debug("HipChat API token not found, logging message instead:")
         logger.debug(message)
         return
-    headers = _headers(auth_token=token)
-    data = {
-        'message': message[:10000],
-        'color': color,
-        'notify': notify,
-        'message_format': message_format,
-        'from': label[:64] if label else ''
-    }
+    if color not in VALID_COLORS:
+        raise ValueError("Invalid color value: {}".format(color))
+    if message_format not in VALID_FORMATS:
+        raise ValueError("Invalid format: {}".format(message_format))
+
+    headers = _AUTH_HEADERS[_token()]
+    body = _body(message, color, label, notify, message_format)
+
+    request = _prepared_request(url)
+    request.headers.update(headers)
+    request.body = body
+    request.headers['Content-Length'] = str(len(body))
+
+    # as Session.request does, pick up proxies, CA bundle etc. from the
+    # environment (e.g. REQUESTS_CA_BUNDLE for self-hosted servers)
+    settings = _SESSION.merge_environment_settings(request.url, {}, None, None, None)
 
     try:
-        resp = requests.post(url, json=data, headers=headers)
+        resp = _SESSION.send(request, timeout=REQUEST_TIMEOUT, **settings)
         resp.raise_for_status()
         return resp
     except requests.HTTPError as ex:
@@ -209,14 +385,12 @@ def notify_user(
 
 def yellow(room, message, **kwargs):
     """Send a yellow message to a room."""
-    kwargs['color'] = 'yellow'
-    return notify_room(room, message, **kwargs)
+    return notify_room(room, message, color='yellow', **kwargs)
 
 
 def gray(room, message, **kwargs):
     """Send a gray message to a room."""
-    kwargs['color'] = 'gray'
-    return notify_room(room, message, **kwargs)
+    return notify_room(room, message, color='gray', **kwargs)
 
 
 # Aliased for UK spelling.
@@ -225,17 +399,14 @@ grey = gray
 
 def green(room, message, **kwargs):
     """Send a green message to a room."""
-    kwargs['color'] = 'green'
-    return notify_room(room, message, **kwargs)
+    return notify_room(room, message, color='green', **kwargs)
 
 
 def purple(room, message, **kwargs):
     """Send a purple message to a room."""
-    kwargs['color'] = 'purple'
-    return notify_room(room, message, **kwargs)
+    return notify_room(room, message, color='purple', **kwargs)
 
 
 def red(room, message, **kwargs):
     """Send a red message to a room."""
-    kwargs['color'] = 'red'
-    return notify_room(room, message, **kwargs)
+    return notify_room(room, message, color='red', **kwargs)
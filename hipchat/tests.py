@@ -1,27 +1,45 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
 import requests
+import threading
+import time
 import unittest
 
-from .compat import mock
+from .compat import mock, QueueListener
 from .exceptions import HipChatError
 from .logger import HipChatHandler
 from .notifications import (
     _api,
+    _body,
+    _BODY_SUFFIXES,
     _headers,
+    _JitterRetry,
+    _prepared_request,
+    _refresh_tokens,
+    _SESSION,
     _token,
     gray,
     green,
     grey,
+    MAX_MESSAGE_LENGTH,
     notify_room,
     notify_user,
     purple,
     red,
+    REQUEST_TIMEOUT,
     SEND_ROOM_MESSAGE_URL,
     SEND_USER_MESSAGE_URL,
     yellow,
 )
 
+try:
+    import asyncio
+    from . import async_notifications
+except (ImportError, SyntaxError):
+    # requires Python 3.5+ and aiohttp
+    async_notifications = None
+
 
 class LoggerTests(unittest.TestCase):
 
@@ -68,6 +86,255 @@ class LoggerTests(unittest.TestCase):
             notify=True
         )
 
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_message(self, mock_notify):
+        handler = HipChatHandler('token', 'room')
+        self.logger.handlers = [handler]
+        self.logger.info('foo %s')
+        self.assertEqual(mock_notify.call_args[0][1], 'foo %s')
+        self.logger.info('foo %s', 'bar')
+        self.assertEqual(mock_notify.call_args[0][1], 'foo bar')
+        self.logger.info(ValueError('baz'))
+        self.assertEqual(mock_notify.call_args[0][1], 'baz')
+
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_colors(self, mock_notify):
+        handler = HipChatHandler('token', 'room', colors={'WARN': 'green', 'FOO': 'red'})
+        self.logger.handlers = [handler]
+        self.logger.warning('foo')
+        self.assertEqual(mock_notify.call_args[1]['color'], 'green')
+        # levels without a color fall back to yellow
+        self.logger.error('foo')
+        self.assertEqual(mock_notify.call_args[1]['color'], 'yellow')
+
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_colors_changed(self, mock_notify):
+        handler = HipChatHandler('token', 'room', colors={'INFO': 'yellow'})
+        self.logger.handlers = [handler]
+        self.logger.info('foo')
+        self.assertEqual(mock_notify.call_args[1]['color'], 'yellow')
+        # modified in place
+        handler.colors['INFO'] = 'green'
+        self.logger.info('foo')
+        self.assertEqual(mock_notify.call_args[1]['color'], 'green')
+        # replaced
+        handler.colors = {'INFO': 'red'}
+        self.logger.info('foo')
+        self.assertEqual(mock_notify.call_args[1]['color'], 'red')
+
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_colors_aliases(self, mock_notify):
+        # the exact level name wins over the alias, whatever the order
+        handler = HipChatHandler('token', 'room', colors={'WARNING': 'red', 'WARN': 'green'})
+        self.logger.handlers = [handler]
+        self.logger.warning('foo')
+        self.assertEqual(mock_notify.call_args[1]['color'], 'red')
+
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_colors_custom_level(self, mock_notify):
+        handler = HipChatHandler('token', 'room', colors={'NOTICE': 'green'})
+        self.logger.handlers = [handler]
+        self.logger.info('foo')
+        # level registered after the color table is built
+        logging.addLevelName(25, 'NOTICE')
+        self.logger.log(25, 'foo')
+        self.assertEqual(mock_notify.call_args[1]['color'], 'green')
+
+    @unittest.skipIf(QueueListener is None, "QueueListener requires Python 3.2+")
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_install(self, mock_notify):
+        handler = HipChatHandler('token', 'room')
+        self.logger.handlers = []
+        listener = handler.install(self.logger)
+        self.logger.info('foo')
+        listener.stop()
+        mock_notify.assert_called_once_with(
+            'room',
+            'foo',
+            color='yellow',
+            label='',
+            message_format='html',
+            notify=False
+        )
+
+    @unittest.skipIf(QueueListener is None, "QueueListener requires Python 3.2+")
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_install_full(self, mock_notify):
+        handler = HipChatHandler('token', 'room')
+        self.logger.handlers = []
+        with mock.patch.object(QueueListener, 'start'):
+            handler.install(self.logger, maxsize=1)
+        self.logger.info('foo')
+        self.logger.info('bar')
+        self.assertEqual(self.logger.handlers[0].dropped, 1)
+        mock_notify.assert_not_called()
+
+    @unittest.skipIf(QueueListener is None, "QueueListener requires Python 3.2+")
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_install_stop_full(self, mock_notify):
+        sending = threading.Event()
+        resume = threading.Event()
+
+        def notify_room(*args, **kwargs):
+            sending.set()
+            resume.wait(5)
+
+        mock_notify.side_effect = notify_room
+        handler = HipChatHandler('token', 'room')
+        self.logger.handlers = []
+        listener = handler.install(self.logger, maxsize=2, batch_size=1)
+        self.logger.info('foo')
+        # the listener is blocked sending 'foo', so the queue fills up
+        self.assertTrue(sending.wait(5))
+        self.logger.info('bar')
+        self.logger.info('baz')
+        self.logger.info('qux')
+        self.assertEqual(listener.dropped, 1)
+        timer = threading.Timer(0.1, resume.set)
+        timer.start()
+        # stop waits for room for the sentinel, rather than raising queue.Full
+        listener.stop()
+        timer.join()
+        self.assertEqual(
+            [c[0][1] for c in mock_notify.call_args_list],
+            ['foo', 'bar', 'baz']
+        )
+
+    @unittest.skipIf(QueueListener is None, "QueueListener requires Python 3.2+")
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_install_exception(self, mock_notify):
+        handler = HipChatHandler('token', 'room')
+        self.logger.handlers = []
+        listener = handler.install(self.logger)
+        try:
+            raise ValueError('bar')
+        except ValueError:
+            self.logger.exception('foo %s', 'baz')
+        listener.stop()
+        # the traceback is not sent, same as when not using install
+        mock_notify.assert_called_once_with(
+            'room',
+            'foo baz',
+            color='red',
+            label='',
+            message_format='html',
+            notify=False
+        )
+
+    @unittest.skipIf(QueueListener is None, "QueueListener requires Python 3.2+")
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_install_error(self, mock_notify):
+        mock_notify.side_effect = [HipChatError.__new__(HipChatError), None]
+        handler = HipChatHandler('token', 'room')
+        handler.handleError = mock.Mock()
+        self.logger.handlers = []
+        listener = handler.install(self.logger, batch_size=1)
+        self.logger.info('foo')
+        self.logger.info('bar')
+        listener.stop()
+        # the failed send is handled, and the listener carries on
+        self.assertEqual(handler.handleError.call_count, 1)
+        self.assertEqual(mock_notify.call_count, 2)
+        self.assertEqual(mock_notify.call_args[0][1], 'bar')
+
+    @unittest.skipIf(QueueListener is None, "QueueListener requires Python 3.2+")
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_install_filters(self, mock_notify):
+        handler = HipChatHandler('token', 'room')
+        handler.addFilter(lambda record: record.msg != 'foo')
+        self.logger.handlers = []
+        with mock.patch.object(QueueListener, 'start'):
+            listener = handler.install(self.logger)
+        # handler level changed after install
+        handler.setLevel(logging.INFO)
+        self.logger.info('foo')
+        self.logger.debug('bar')
+        self.logger.info('baz')
+        listener.start()
+        # every record is marked done, so join() returns
+        listener.queue.join()
+        listener.stop()
+        self.assertEqual(listener.queue.unfinished_tasks, 0)
+        mock_notify.assert_called_once_with(
+            'room',
+            'baz',
+            color='yellow',
+            label='',
+            message_format='html',
+            notify=False
+        )
+
+    @unittest.skipIf(QueueListener is None, "QueueListener requires Python 3.2+")
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_install_filter_once(self, mock_notify):
+        handler = HipChatHandler('token', 'room')
+        filtered = []
+
+        def record_filter(record):
+            filtered.append(record.msg[0])
+            return True
+
+        handler.addFilter(record_filter)
+        self.logger.handlers = []
+        with mock.patch.object(QueueListener, 'start'):
+            listener = handler.install(self.logger)
+        self.logger.info('x' * MAX_MESSAGE_LENGTH)
+        # too long to join the first batch, so carried over to the next
+        self.logger.info('y')
+        listener.start()
+        listener.stop()
+        self.assertEqual(mock_notify.call_count, 2)
+        # each record is only filtered once
+        self.assertEqual(filtered, ['x', 'y'])
+
+    @unittest.skipIf(QueueListener is None, "QueueListener requires Python 3.2+")
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_install_batch_window(self, mock_notify):
+        handler = HipChatHandler('token', 'room')
+        self.logger.handlers = []
+        listener = handler.install(self.logger, batch_window=0.2)
+        # a steady trickle of records, each arriving within batch_window of
+        # the last - batches are still sent batch_window after they start
+        for _ in range(10):
+            self.logger.info('foo')
+            time.sleep(0.1)
+        listener.stop()
+        self.assertGreaterEqual(mock_notify.call_count, 3)
+
+    @unittest.skipIf(QueueListener is None, "QueueListener requires Python 3.2+")
+    @mock.patch('hipchat.logger.notify_room')
+    def test_logger_install_batch(self, mock_notify):
+        handler = HipChatHandler('token', 'room')
+        self.logger.handlers = []
+        with mock.patch.object(QueueListener, 'start'):
+            listener = handler.install(self.logger)
+        self.logger.info('foo')
+        self.logger.error('bar')
+        self.logger.debug('x' * MAX_MESSAGE_LENGTH)
+        listener.start()
+        listener.queue.join()
+        listener.stop()
+        self.assertEqual(listener.queue.unfinished_tasks, 0)
+        self.assertEqual(mock_notify.call_count, 2)
+        mock_notify.assert_has_calls([
+            mock.call(
+                'room',
+                'foo<br/>bar',
+                color='red',
+                label='',
+                message_format='html',
+                notify=False
+            ),
+            mock.call(
+                'room',
+                'x' * MAX_MESSAGE_LENGTH,
+                color='gray',
+                label='',
+                message_format='html',
+                notify=False
+            ),
+        ])
+
 
 class ErrorTests(unittest.TestCase):
 
@@ -86,13 +353,13 @@ class ErrorTests(unittest.TestCase):
         response.status_code = 200
         self.assertRaises(AssertionError, HipChatError, response)
 
-        # error status code, incorrectly formatted response.json()
+        # error status code, incorrectly formatted response.content
         response.status_code = 400
-        response.json.return_value = {}
+        response.content = b'{}'
         self.assertRaises(AssertionError, HipChatError, response)
 
         # should pass
-        response.json.return_value = data
+        response.content = json.dumps(data).encode('utf-8')
         error = HipChatError(response)
         self.assertEqual(error.status_code, 400)
         self.assertEqual(error.message, 'foobar')
@@ -102,53 +369,98 @@ class FunctionTests(unittest.TestCase):
 
     """hipchat module function tests."""
 
+    def tearDown(self):
+        # reset the token pool from the unpatched environment
+        _refresh_tokens()
+
+    def _posted_json(self, mock_send):
+        """Return the decoded JSON body of the last mock_send call."""
+        return json.loads(mock_send.call_args[0][0].body.decode('utf-8'))
+
     def test__token(self):
         """Test _token function can handle all variations of HIPCHAT_API_TOKEN."""
         # no env var set, should be None
         self.assertIsNone(_token())
         # a single token
         with mock.patch.dict('os.environ', {'HIPCHAT_API_TOKEN': 'abc'}):
+            _refresh_tokens()
             self.assertEqual(_token(), 'abc')
         # multiple tokens - can't be sure which one we'll get,
         # but can check that the string is split correctly
         with mock.patch.dict('os.environ', {'HIPCHAT_API_TOKEN': 'abc,def , ghi'}):
+            _refresh_tokens()
             self.assertTrue(_token() in ['abc', 'def', 'ghi'])
+        # empty tokens are ignored
+        with mock.patch.dict('os.environ', {'HIPCHAT_API_TOKEN': ' , '}):
+            _refresh_tokens()
+            self.assertIsNone(_token())
 
     def test__headers(self):
         """Test _headers formats token correctly."""
         self.assertEqual(
             _headers('foo'),
-            {
-                'Authorization': 'Bearer foo',
-                'Host': 'api.hipchat.com',
-                'Content-Type': 'application/json'
-            }
+            {'Authorization': 'Bearer foo'}
+        )
+
+    def test__session(self):
+        """Test the shared session carries the static headers."""
+        self.assertEqual(_SESSION.headers['Host'], 'api.hipchat.com')
+        self.assertEqual(_SESSION.headers['Content-Type'], 'application/json')
+        adapter = _SESSION.get_adapter('https://api.hipchat.com')
+        self.assertIsInstance(adapter.max_retries, _JitterRetry)
+        self.assertIn(429, adapter.max_retries.status_forcelist)
+        # read errors on the (non-idempotent) POST are not retried
+        self.assertIs(adapter.max_retries.read, False)
+        self.assertFalse(adapter.max_retries.is_retry('POST', 200))
+        self.assertTrue(adapter.max_retries.is_retry('POST', 429))
+        self.assertEqual(
+            adapter.poolmanager.connection_pool_kw['socket_options'],
+            adapter.socket_options
         )
 
-    @mock.patch('requests.post')
-    def test__api(self, mock_post):
+    @mock.patch('random.uniform', lambda a, b: b)
+    def test__jitter_retry(self):
+        """Test the backoff time includes the jitter."""
+        retry = _JitterRetry(total=5, backoff_factor=0.5)
+        self.assertEqual(retry.get_backoff_time(), 0.5)
+
+    @mock.patch('hipchat.notifications._SESSION.send')
+    def test__api(self, mock_send):
         """Test all code paths in the _api function work as expected."""
+        url = SEND_ROOM_MESSAGE_URL('foo')
         # message is too short, long, missing
-        self.assertRaises(AssertionError, _api, 'url', None)
-        self.assertRaises(AssertionError, _api, 'url', '')
-        # colour, format is invalid
-        self.assertRaises(AssertionError, _api, 'url', 'foo', color='black')
-        self.assertRaises(AssertionError, _api, 'url', 'foo', message_format='png')
-        # no token - doesn't call api
-        self.assertIsNone(_api('foo', 'bar'))
-        mock_post.assert_not_called()
+        self.assertRaises(ValueError, _api, url, None)
+        self.assertRaises(ValueError, _api, url, '')
+        # no token - doesn't call api, or check the colour / format
+        self.assertIsNone(_api(url, 'bar'))
+        self.assertIsNone(_api(url, 'bar', color='black'))
+        mock_send.assert_not_called()
         # set a token
         with mock.patch.dict('os.environ', {'HIPCHAT_API_TOKEN': 'token'}):
+            _refresh_tokens()
+            # colour, format is invalid
+            self.assertRaises(ValueError, _api, url, 'foo', color='black')
+            self.assertRaises(ValueError, _api, url, 'foo', message_format='png')
             # try the defaults
-            self.assertEqual(_api('foo', 'bar'), mock_post.return_value)
-            mock_post.assert_called_once_with(
-                'foo',
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': 'Bearer token',
-                    'Host': 'api.hipchat.com'
-                },
-                json={
+            self.assertEqual(_api(url, 'bar'), mock_send.return_value)
+            mock_send.assert_called_once_with(
+                mock.ANY,
+                timeout=REQUEST_TIMEOUT,
+                proxies=mock.ANY,
+                stream=mock.ANY,
+                verify=mock.ANY,
+                cert=None
+            )
+            request = mock_send.call_args[0][0]
+            self.assertEqual(request.method, 'POST')
+            self.assertEqual(request.url, url)
+            self.assertEqual(request.headers['Authorization'], 'Bearer token')
+            self.assertEqual(request.headers['Host'], 'api.hipchat.com')
+            self.assertEqual(request.headers['Content-Type'], 'application/json')
+            self.assertEqual(request.headers['Content-Length'], str(len(request.body)))
+            self.assertEqual(
+                self._posted_json(mock_send),
+                {
                     'notify': False,
                     'message_format': 'html',
                     'color': 'yellow',
@@ -158,17 +470,12 @@ class FunctionTests(unittest.TestCase):
             )
             # try the kwargs
             self.assertEqual(
-                _api('foo', 'bar', color='red', label='baz', notify=True, message_format='text'),
-                mock_post.return_value
+                _api(url, 'bar', color='red', label='baz', notify=True, message_format='text'),
+                mock_send.return_value
             )
-            mock_post.assert_called_with(
-                'foo',
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': 'Bearer token',
-                    'Host': 'api.hipchat.com'
-                },
-                json={
+            self.assertEqual(
+                self._posted_json(mock_send),
+                {
                     'notify': True,
                     'message_format': 'text',
                     'color': 'red',
@@ -176,12 +483,39 @@ class FunctionTests(unittest.TestCase):
                     'from': 'baz',
                 }
             )
+            # the cached request is not modified
+            self.assertNotIn('Authorization', _prepared_request(url).headers)
+
+            # message and label are truncated
+            _api(url, 'x' * (MAX_MESSAGE_LENGTH + 1), label='y' * 65)
+            data = self._posted_json(mock_send)
+            self.assertEqual(data['message'], 'x' * MAX_MESSAGE_LENGTH)
+            self.assertEqual(data['from'], 'y' * 64)
+
+            # environment settings are applied
+            with mock.patch.dict('os.environ', {'REQUESTS_CA_BUNDLE': '/ca.pem'}):
+                _api(url, 'bar')
+            self.assertEqual(mock_send.call_args[1]['verify'], '/ca.pem')
 
             # force response.raise_for_status to raise an error
-            response = mock.Mock(status_code=400)
-            response.json.return_value = {'error': {'message': 'uh-oh'}}
-            mock_post.side_effect = requests.HTTPError(response=response)
-            self.assertRaises(HipChatError, _api, 'foo', 'bar')
+            response = mock.Mock(status_code=400, content=b'{"error": {"message": "uh-oh"}}')
+            mock_send.side_effect = requests.HTTPError(response=response)
+            self.assertRaises(HipChatError, _api, url, 'bar')
+
+    def test__body(self):
+        """Test _body encodes the message onto the cached suffix."""
+        body = _body(u'"bär"', 'red', None, True, 'text')
+        self.assertEqual(
+            json.loads(body.decode('utf-8')),
+            {
+                'notify': True,
+                'message_format': 'text',
+                'color': 'red',
+                'message': u'"bär"',
+                'from': '',
+            }
+        )
+        self.assertIn(('red', None, True, 'text'), _BODY_SUFFIXES)
 
     @mock.patch('hipchat.notifications._api')
     def test_notify_room(self, mock_api):
@@ -238,5 +572,100 @@ class FunctionTests(unittest.TestCase):
         mock_api.assert_called_once_with('foo', 'bar', color='red')
 
 
+def _done(loop, result=None, exception=None):
+    """Return a completed future, which can be awaited like a coroutine."""
+    future = loop.create_future()
+    if exception is None:
+        future.set_result(result)
+    else:
+        future.set_exception(exception)
+    return future
+
+
+class _AsyncContext(object):
+
+    """Async context manager for value (written without async def for Python 2)."""
+
+    def __init__(self, loop, value):
+        self.loop = loop
+        self.value = value
+
+    def __aenter__(self):
+        return _done(self.loop, self.value)
+
+    def __aexit__(self, *args):
+        return _done(self.loop, False)
+
+
+@unittest.skipIf(async_notifications is None, "Requires Python 3.5+ and aiohttp")
+class AsyncFunctionTests(unittest.TestCase):
+
+    """hipchat.async_notifications function tests."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        _refresh_tokens()
+
+    def _session(self, status=204, content=b''):
+        """Return a mock aiohttp session whose post returns status."""
+        response = mock.Mock(status=status)
+        response.read.side_effect = lambda: _done(self.loop, content)
+        session = mock.Mock()
+        session.post.return_value = _AsyncContext(self.loop, response)
+        return session
+
+    def test_notify_room_async(self):
+        """Test notify_room_async posts the encoded body."""
+        notify_room_async = async_notifications.notify_room_async
+        session = self._session()
+        # no token - doesn't call api
+        self.assertIsNone(
+            self.loop.run_until_complete(notify_room_async(session, 'foo', 'bar'))
+        )
+        session.post.assert_not_called()
+        with mock.patch.dict('os.environ', {'HIPCHAT_API_TOKEN': 'token'}):
+            _refresh_tokens()
+            self.assertRaises(
+                ValueError,
+                self.loop.run_until_complete,
+                notify_room_async(session, 'foo', 'bar', color='black')
+            )
+            resp = self.loop.run_until_complete(notify_room_async(session, 'foo', 'bar'))
+            self.assertEqual(resp.status, 204)
+            session.post.assert_called_once_with(
+                SEND_ROOM_MESSAGE_URL('foo'),
+                data=_body('bar', 'yellow', None, False, 'html'),
+                headers={
+                    'Content-Type': 'application/json',
+                    'Authorization': 'Bearer token'
+                },
+                timeout=async_notifications._TIMEOUT
+            )
+            # error responses are raised as HipChatError
+            session = self._session(400, b'{"error": {"message": "uh-oh"}}')
+            with self.assertRaises(HipChatError) as ctx:
+                self.loop.run_until_complete(notify_room_async(session, 'foo', 'bar'))
+            self.assertEqual(ctx.exception.message, 'uh-oh')
+
+    @mock.patch('hipchat.async_notifications.notify_room_async', new_callable=mock.Mock)
+    def test_broadcast(self, mock_notify):
+        """Test broadcast notifies each room, returning errors."""
+        error = ValueError()
+        # a plain Mock, not AsyncMock, so it behaves the same on all versions
+        mock_notify.side_effect = [
+            _done(self.loop, 'ok'),
+            _done(self.loop, exception=error),
+        ]
+        results = self.loop.run_until_complete(
+            async_notifications.broadcast(['foo', 'bar'], 'baz', color='red')
+        )
+        self.assertEqual(results, ['ok', error])
+        self.assertEqual(mock_notify.call_count, 2)
+        mock_notify.assert_called_with(mock.ANY, 'bar', 'baz', color='red')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -14,7 +14,11 @@ setup(
     version="0.4.1",
     packages=find_packages(),
     include_package_data=True,
-    install_requires=['requests>=2.1'],
+    install_requires=['requests>=2.1', 'urllib3>=1.26'],
+    extras_require={
+        'async': ['aiohttp>=3.3'],
+        'orjson': ['orjson'],
+    },
     license='MIT',
     description="Basic functions for sending notifications via HipChat API (v2)",
     long_description=README,